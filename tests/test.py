@@ -1,8 +1,24 @@
 from nose.tools import *
 from workoutbot.progression import *
 from workoutbot.utils import *
+from workoutbot.hours import *
+from workoutbot.roster import *
+from workoutbot.status import *
+from workoutbot.messages import *
+from workoutbot.bot import Bot
+from workoutbot import scheduler
+from datetime import datetime, timezone
 from math import floor
 import sqlite3
+import tempfile
+import pickle
+import os
+import random
+import json
+import threading
+import subprocess
+import time
+import sys
 
 def test_next_point():
     progressions = load_exercises("exercises.json")
@@ -93,3 +109,601 @@ def test_user():
     assert_equal(user.focus, other.focus)
     assert_equal(user.exclude, other.exclude)
     assert_equal(user.progress, other.progress)
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+def test_user_working_hours():
+    progressions = load_exercises("exercises.json")
+    user = User("foo", "Bob", 1, timezone="Europe/Berlin", work_start=9,
+                work_end=18, work_days={0, 1, 2})
+    conn = setup_db(":memory:")
+    user.save(conn)
+    other = User.from_db(conn, "foo", progressions)
+    assert_equal(other.timezone, "Europe/Berlin")
+    assert_equal(other.work_start, 9)
+    assert_equal(other.work_end, 18)
+    assert_equal(other.work_days, {0, 1, 2})
+
+def test_setup_db_adds_columns():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workout.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+        CREATE TABLE user(
+           id TEXT NOT NULL PRIMARY KEY,
+           name TEXT NOT NULL,
+           interval INTEGER NOT NULL,
+           focus TEXT,
+           exclude TEXT,
+           last_progression TEXT
+        );
+        """)
+        conn.execute("insert into user values(?, ?, ?, ?, ?, ?)",
+                     ("foo", "Bob", 1, pickle.dumps(set()), pickle.dumps(set()), None))
+        conn.commit()
+        conn.close()
+
+        conn = setup_db(path)
+        other = User.from_db(conn, "foo", {})
+        assert_equal(other.timezone, DEFAULT_TIMEZONE)
+        assert_equal(other.work_start, DEFAULT_WORK_START)
+        assert_equal(other.work_days, DEFAULT_WORK_DAYS)
+        conn.close()
+
+def test_bot_migrates_once_per_process():
+    import workoutbot.bot
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workout.db")
+        conn = sqlite3.connect(path)
+        conn.execute("""
+        CREATE TABLE user(
+           id TEXT NOT NULL PRIMARY KEY,
+           name TEXT NOT NULL,
+           interval INTEGER NOT NULL,
+           focus TEXT,
+           exclude TEXT,
+           last_progression TEXT
+        )""")
+        conn.commit()
+        conn.close()
+
+        calls = []
+        def counting_setup_db(name):
+            calls.append(name)
+            return setup_db(name)
+
+        bot = Bot("token", "secret", "C1", db_name=path)
+        errors = []
+        def connect():
+            try:
+                bot.db().execute("select modified from user").fetchall()
+            except Exception as e:
+                errors.append(e)
+
+        workoutbot.bot.setup_db = counting_setup_db
+        try:
+            threads = [threading.Thread(target=connect) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            workoutbot.bot.setup_db = setup_db
+        assert_equal(errors, [])
+        assert_equal(calls, [path])
+
+def test_is_working_hours():
+    # 2019-01-07 is a Monday; Chicago is UTC-6 in winter
+    user = User("foo", "Bob", 1, timezone="America/Chicago")
+    assert_false(is_working_hours(user, utc(2019, 1, 7, 13, 59)))
+    assert_true(is_working_hours(user, utc(2019, 1, 7, 14, 0)))
+    assert_true(is_working_hours(user, utc(2019, 1, 7, 22, 59)))
+    assert_false(is_working_hours(user, utc(2019, 1, 7, 23, 0)))
+    # Saturday
+    assert_false(is_working_hours(user, utc(2019, 1, 12, 15, 0)))
+
+def test_parse_days():
+    assert_equal(parse_days("mon-thu"), {0, 1, 2, 3})
+    assert_equal(parse_days("Mon,Wed,fri"), {0, 2, 4})
+    assert_equal(parse_days("sat-mon"), {5, 6, 0})
+    assert_equal(parse_days("tuesday"), {1})
+    assert_raises(ValueError, parse_days, "someday")
+    assert_raises(ValueError, parse_days, "mon-tue-wed")
+    assert_equal(format_days({4, 0, 2}), "mon,wed,fri")
+
+def test_next_window_open():
+    user = User("foo", "Bob", 1, timezone="America/Chicago")
+    now = utc(2019, 1, 7, 15, 0)
+    assert_equal(next_window_open(user, now), now)
+    # Monday evening opens Tuesday morning
+    assert_equal(next_window_open(user, utc(2019, 1, 7, 23, 30)),
+                 utc(2019, 1, 8, 14, 0))
+    # Friday evening skips the weekend
+    assert_equal(next_window_open(user, utc(2019, 1, 11, 23, 30)),
+                 utc(2019, 1, 14, 14, 0))
+    # Across the DST change the UTC opening time moves by an hour
+    assert_equal(next_window_open(user, utc(2019, 3, 8, 23, 30)),
+                 utc(2019, 3, 11, 13, 0))
+    user.work_days = set()
+    assert_is_none(next_window_open(user, now))
+
+def test_next_wake():
+    chicago = User("foo", "Bob", 1, timezone="America/Chicago")
+    berlin = User("bar", "Alice", 1, timezone="Europe/Berlin")
+    # Monday 06:00 UTC: night in Chicago, morning in Berlin opens at 07:00 UTC
+    now = utc(2019, 1, 7, 6, 0)
+    assert_equal(next_wake([chicago, berlin], now, 120), 3600)
+    # Berlin is in working hours, so poll normally
+    now = utc(2019, 1, 7, 10, 0)
+    assert_equal(next_wake([chicago, berlin], now, 120), 120)
+    # Chicago opens within the poll interval
+    now = utc(2019, 1, 7, 13, 59)
+    assert_equal(next_wake([chicago, berlin], now, 120), 60)
+    assert_is_none(next_wake([], now, 120))
+
+class FakeSlackClient:
+    def __init__(self, members, page_size):
+        self.members = members
+        self.page_size = page_size
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        start = int(kwargs.get("cursor") or 0)
+        end = start + self.page_size
+        next_cursor = str(end) if end < len(self.members) else ""
+        return {
+            "ok": True,
+            "members": self.members[start:end],
+            "response_metadata": {"next_cursor": next_cursor}
+        }
+
+def test_roster_full_sync_pages():
+    sc = FakeSlackClient(["U{}".format(i) for i in range(5)], 2)
+    conn = setup_db(":memory:")
+    roster = RosterSync(lambda: sc, "C1", lambda: conn, full_sync_interval=100, page_size=2)
+    joined, left = roster.sync(0)
+    assert_equal(joined, set(sc.members))
+    assert_equal(left, set())
+    assert_equal(len(sc.calls), 3)
+
+def test_roster_applies_events_between_syncs():
+    sc = FakeSlackClient(["U1", "U2"], 10)
+    conn = setup_db(":memory:")
+    roster = RosterSync(lambda: sc, "C1", lambda: conn, full_sync_interval=100)
+    roster.sync(0)
+
+    # Events may be recorded by another process, e.g. a web worker
+    record_member_event(conn, "C1", "U3", True)
+    record_member_event(conn, "C2", "U4", True)
+    record_member_event(conn, "C1", "U1", False)
+    joined, left = roster.sync(10)
+    assert_equal(joined, {"U3"})
+    assert_equal(left, {"U1"})
+    assert_equal(len(sc.calls), 1)
+
+    # Nothing changed, no work to do
+    assert_equal(roster.sync(20), (set(), set()))
+    assert_equal(len(sc.calls), 1)
+
+    # The next full sync reconciles against the real member list
+    joined, left = roster.sync(100)
+    assert_equal(joined, {"U1"})
+    assert_equal(left, {"U3"})
+    assert_equal(len(sc.calls), 2)
+
+def test_status_checkpoint():
+    conn = setup_db(":memory:")
+    statuses = {
+        "foo": UserStatus(User("foo", "Bob", 30)),
+        "bar": UserStatus(User("bar", "Alice", 30)),
+    }
+    statuses["foo"].active = True
+    statuses["foo"].last_became_active = 100.0
+    statuses["foo"].last_challenged = 200.0
+    assert_equal(checkpoint_statuses(conn, statuses.values()), 2)
+    # Unchanged statuses are not rewritten
+    assert_equal(checkpoint_statuses(conn, statuses.values()), 0)
+    statuses["bar"].active = True
+    assert_equal(checkpoint_statuses(conn, statuses.values()), 1)
+
+    restored = {
+        "foo": UserStatus(User("foo", "Bob", 30)),
+        "bar": UserStatus(User("bar", "Alice", 30)),
+    }
+    restore_statuses(conn, restored)
+    assert_equal(restored["foo"].state(), statuses["foo"].state())
+    assert_equal(restored["bar"].state(), statuses["bar"].state())
+    assert_equal(checkpoint_statuses(conn, restored.values()), 0)
+
+def test_spread_due_challenges():
+    # Monday 09:00 in the default timezone, inside working hours
+    now = utc(2019, 1, 7, 15, 0)
+    due = [UserStatus(User(str(i), "Bob", 30)) for i in range(50)]
+    recent = UserStatus(User("recent", "Alice", 30))
+    recent.last_challenged = now - 60
+    spread_due_challenges(due + [recent], now, 600)
+    assert_is_none(recent.not_before)
+    for status in due:
+        assert_greater_equal(status.not_before, now)
+        assert_less_equal(status.not_before, now + 600)
+    assert_greater(len(set(s.not_before for s in due)), 1)
+
+def test_spread_due_challenges_off_hours():
+    # Monday 03:00 in Chicago, the window opens at 08:00 local (14:00 UTC)
+    now = utc(2019, 1, 7, 9, 0)
+    opens = utc(2019, 1, 7, 14, 0)
+    due = [UserStatus(User(str(i), "Bob", 30, timezone="America/Chicago"))
+           for i in range(50)]
+    spread_due_challenges(due, now, 600)
+    for status in due:
+        assert_greater_equal(status.not_before, opens)
+        assert_less_equal(status.not_before, opens + 600)
+
+def test_digest_messages():
+    progressions = load_exercises("exercises.json")
+    challenges = []
+    for id, name in [("foo", "Bob"), ("bar", "Alice")]:
+        user = User(id, name, 30)
+        for p in progressions.values():
+            stage = p.stages[0]
+            user.register_point(p, stage.workout.name, stage.max)
+        challenges.append(generate_challenge(user))
+
+    attachments = digest_attachments(challenges)
+    assert_equal(len(attachments), 2)
+    assert_in("@Bob", attachments[0]["text"])
+    assert_in("@Alice", attachments[1]["text"])
+
+    prompt = done_prompt_attachments(challenges[0], "123.456", digest=True)
+    for action in prompt[0]["actions"]:
+        value = json.loads(action["value"])
+        assert_equal(value["ts"], "123.456")
+        assert_true(value["digest"])
+        assert_equal(value["progression"], challenges[0].progression.name)
+    value = json.loads(done_prompt_attachments(challenges[0], "1")[0]["actions"][0]["value"])
+    assert_not_in("digest", value)
+
+def test_refresh_users():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workout.db")
+        bot = Bot("token", "secret", "C1", db_name=path)
+        other = setup_db(path)
+        User("foo", "Bob", 30).save(other)
+        users = bot.refresh_users(bot.db())
+        assert_equal(users["foo"].user.interval, 30)
+
+        # Changes saved by another process are picked up, and the
+        # scheduler state for the user is kept
+        users["foo"].last_challenged = 100.0
+        User("foo", "Bob", 60).save(other)
+        User("bar", "Alice", 90).save(other)
+        users = bot.refresh_users(bot.db())
+        assert_equal(users["foo"].user.interval, 60)
+        assert_equal(users["foo"].last_challenged, 100.0)
+        assert_equal(users["bar"].user.interval, 90)
+
+        # Saves made by this process don't cause a reload
+        user = users["foo"].user
+        user.interval = 15
+        user.save(bot.db())
+        users = bot.refresh_users(bot.db())
+        assert_true(users["foo"].user is user)
+        other.close()
+
+def test_last_progression_survives_web_saves():
+    progressions = load_exercises("exercises.json")
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workout.db")
+        web = setup_db(path)
+        user = User("foo", "Bob", 30)
+        for p in progressions.values():
+            user.register_point(p, p.stages[0].workout.name, p.stages[0].max)
+        user.save(web)
+
+        # The scheduler process challenges the user...
+        bot = Bot("token", "secret", "C1", db_name=path)
+        status = bot.refresh_users(bot.db())["foo"]
+        challenge = generate_challenge(status.user)
+        status.user.challenged_with(challenge)
+        checkpoint_statuses(bot.db(), [status])
+
+        # ...then the web process saves its own, older copy after a rating
+        User.from_db(web, "foo", progressions).save(web)
+        users = bot.refresh_users(bot.db())
+        assert_equal(users["foo"].user.last_progression, challenge.progression.name)
+
+        # A restarted scheduler gets it back from the saved status
+        restarted = Bot("token", "secret", "C1", db_name=path)
+        users = restarted.refresh_users(restarted.db())
+        restore_statuses(restarted.db(), users)
+        assert_equal(users["foo"].user.last_progression, challenge.progression.name)
+        web.close()
+
+def test_set_interval():
+    from workoutbot.server import create_app
+    with tempfile.TemporaryDirectory() as d:
+        bot = Bot("token", "secret", "C1", db_name=os.path.join(d, "workout.db"))
+        client = create_app(bot).test_client()
+        User("foo", "Bob", 30).save(bot.db())
+
+        resp = client.post("/set-interval", data={"text": "45", "user_id": "foo"})
+        assert_equal(resp.get_json()["text"], "Interval set to every 45 minutes")
+        assert_equal(User.from_db(bot.db(), "foo", {}).interval, 45)
+
+        resp = client.post("/set-interval", data={"text": "45", "user_id": "bar"})
+        assert_in("Please register first", resp.get_json()["text"])
+
+def test_registration_across_processes():
+    from workoutbot.server import create_app
+    progressions = load_exercises("exercises.json")
+    progression = list(progressions.values())[1]
+    stage = progression.stages[1]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workout.db")
+        # Each callback may reach a different worker with its own Bot
+        clients = [create_app(Bot("token", "secret", "C1", db_name=path)).test_client()
+                   for _ in range(2)]
+
+        def post(client, callback, action):
+            payload = {"callback_id": callback,
+                       "user": {"id": "foo", "name": "Bob"},
+                       "actions": [action]}
+            resp = client.post("/interactive", data={"payload": json.dumps(payload)})
+            assert_equal(resp.status_code, 200)
+            return resp
+
+        post(clients[0], "user_register_setup", {
+            "name": progression.name,
+            "selected_options": [{"value": stage.workout.name}]})
+        post(clients[1], "user_register_interval", {
+            "name": "interval", "selected_options": [{"value": 90}]})
+        resp = post(clients[0], "user_register", {"name": "submit", "value": "submit"})
+        assert_equal(resp.get_json()["text"], "Registration complete!")
+
+        conn = setup_db(path)
+        user = User.from_db(conn, "foo", progressions)
+        assert_equal(user.interval, 90)
+        assert_equal(user.progress[progression.name].workout, stage.workout.name)
+        assert_equal(conn.execute("select count(*) from registration").fetchone(), (0,))
+        conn.close()
+
+def test_set_hours():
+    from workoutbot.server import create_app
+    with tempfile.TemporaryDirectory() as d:
+        bot = Bot("token", "secret", "C1", db_name=os.path.join(d, "workout.db"))
+        client = create_app(bot).test_client()
+        User("foo", "Bob", 30).save(bot.db())
+
+        resp = client.post("/set-hours", data={"text": "9-18", "user_id": "foo"})
+        assert_in("9:00-18:00 on mon,tue,wed,thu,fri", resp.get_json()["text"])
+
+        resp = client.post("/set-hours", data={"text": "7-15 mon-thu", "user_id": "foo"})
+        assert_in("7:00-15:00 on mon,tue,wed,thu", resp.get_json()["text"])
+        user = User.from_db(bot.db(), "foo", {})
+        assert_equal((user.work_start, user.work_end), (7, 15))
+        assert_equal(user.work_days, {0, 1, 2, 3})
+
+        for text in ["", "9", "9-18 someday", "18-9", "9-18 mon extra"]:
+            resp = client.post("/set-hours", data={"text": text, "user_id": "foo"})
+            assert_true(resp.get_json()["text"].startswith("Error:"))
+        assert_equal(User.from_db(bot.db(), "foo", {}).work_days, {0, 1, 2, 3})
+
+# Seconds allowed for importing workoutbot and building the web app with
+# create_app, on top of importing Flask itself. Measured at ~0.015s; the
+# old import, which created the Slack client, took ~0.06-0.1s.
+STARTUP_BUDGET=0.04
+
+def test_startup_time():
+    # Run in a fresh interpreter without the Slack settings, from an empty
+    # directory, so any import-time environment reads or database and
+    # Slack client creation show up as failures
+    code = """
+import sys, time
+import flask, slackeventsapi
+start = time.perf_counter()
+from workoutbot.server import create_app
+from workoutbot.bot import Bot
+create_app(Bot("token", "secret", "C1"))
+print(time.perf_counter() - start)
+assert "slackclient" not in sys.modules
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {k: v for k, v in os.environ.items() if not k.startswith("SLACK_")}
+    env["PYTHONPATH"] = os.pathsep.join([root, env.get("PYTHONPATH", "")])
+    with tempfile.TemporaryDirectory() as d:
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=d, env=env)
+        assert_equal(os.listdir(d), [])
+    elapsed = float(out.decode().strip().splitlines()[-1])
+    assert_less(elapsed, STARTUP_BUDGET)
+
+class RecordingSlackClient:
+    def __init__(self):
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if method == "users.getPresence":
+            return {"ok": True, "presence": "active"}
+        return {"ok": True, "ts": "{}.0".format(len(self.calls))}
+
+def fake_bot(path, **kwargs):
+    bot = Bot("token", "secret", "C1", db_name=path, **kwargs)
+    bot._sc = RecordingSlackClient()
+    bot._sc_pid = os.getpid()
+    return bot
+
+def test_presence_polled_only_near_challenges():
+    with tempfile.TemporaryDirectory() as d:
+        bot = fake_bot(os.path.join(d, "workout.db"))
+        now = time.time()
+        statuses = []
+        for i in range(10):
+            status = UserStatus(User("U{}".format(i), "Bob", 60))
+            status.in_channel = True
+            statuses.append(status)
+        # Active and challenged a minute ago: nothing to do for a while
+        for status in statuses[:7]:
+            status.active = True
+            status.last_became_active = now - 3600
+            status.last_challenged = now - 60
+        # Active and about to be due
+        statuses[7].active = True
+        statuses[7].last_challenged = now - 59*60
+        # Not active yet, and not in the channel
+        statuses[9].in_channel = False
+
+        scheduler.update_active_users(bot, statuses)
+        polled = [kw["user"] for m, kw in bot.sc.calls if m == "users.getPresence"]
+        assert_equal(polled, ["U7", "U8"])
+
+def registered_user(id, progressions, interval=30):
+    user = User(id, id, interval)
+    for p in progressions.values():
+        # Registration starts users in the middle of their chosen stage
+        stage = p.stages[0]
+        user.register_point(p, stage.workout.name, (stage.min + stage.max) / 2)
+    return user
+
+def test_send_digest_to():
+    progressions = load_exercises("exercises.json")
+    with tempfile.TemporaryDirectory() as d:
+        bot = fake_bot(os.path.join(d, "workout.db"), digest_mode=True)
+        users = [registered_user("U{}".format(i), progressions) for i in range(150)]
+        for user in users:
+            bot.users.add(UserStatus(user))
+
+        scheduler.send_digest_to(bot, users)
+        posts = [(m, kw) for m, kw in bot.sc.calls if m == "chat.postMessage"]
+        prompts = [(m, kw) for m, kw in bot.sc.calls if m == "chat.postEphemeral"]
+        assert_equal(len(bot.sc.calls), 152)
+        assert_equal([len(kw["attachments"]) for m, kw in posts], [100, 50])
+
+        # Each prompt points at the digest post that mentions its user
+        ts = {}
+        for i, (m, kw) in enumerate(bot.sc.calls):
+            if m == "chat.postMessage":
+                post_ts = "{}.0".format(i + 1)
+                mentioned = [a["text"] for a in kw["attachments"]]
+            else:
+                value = json.loads(kw["attachments"][0]["actions"][0]["value"])
+                assert_equal(value["ts"], post_ts)
+                assert_true(value["digest"])
+                assert_true(any("@{}!".format(kw["user"]) in t for t in mentioned))
+                ts[kw["user"]] = value["ts"]
+        assert_equal(len(prompts), 150)
+        assert_equal(set(ts), set(u.id for u in users))
+
+def rating_payload(user, progression, workout, ts, digest):
+    value = {"status": "completed", "progression": progression,
+             "workout": workout, "ts": ts}
+    if digest:
+        value["digest"] = True
+    return json.dumps({
+        "callback_id": "workout_rating",
+        "user": {"id": user.id, "name": user.name},
+        "actions": [{"name": "Easy", "value": json.dumps(value)}]
+    })
+
+def test_workout_rating_digest():
+    from workoutbot.server import create_app
+    progressions = load_exercises("exercises.json")
+    with tempfile.TemporaryDirectory() as d:
+        bot = fake_bot(os.path.join(d, "workout.db"))
+        client = create_app(bot).test_client()
+        user = registered_user("foo", progressions)
+        user.save(bot.db())
+        point = next(iter(user.progress.values()))
+        name = point.progression.name
+
+        client.post("/interactive", data={"payload": rating_payload(
+            user, name, point.workout, "1.0", digest=True)})
+        method, kwargs = bot.sc.calls[-1]
+        assert_equal(method, "chat.postMessage")
+        assert_equal(kwargs["thread_ts"], "1.0")
+        assert_in("@foo", kwargs["text"])
+        assert_greater(User.from_db(bot.db(), "foo", progressions).progress[name].count,
+                       point.count)
+
+        client.post("/interactive", data={"payload": rating_payload(
+            user, name, point.workout, "2.0", digest=False)})
+        method, kwargs = bot.sc.calls[-1]
+        assert_equal(method, "reactions.add")
+        assert_equal(kwargs["timestamp"], "2.0")
+
+def test_concurrent_handlers_and_scheduler():
+    from workoutbot.server import create_app
+    progressions = load_exercises("exercises.json")
+    with tempfile.TemporaryDirectory() as d:
+        bot = fake_bot(os.path.join(d, "workout.db"))
+        app = create_app(bot)
+        users = [registered_user("U{}".format(i), progressions) for i in range(4)]
+        for user in users:
+            user.save(bot.db())
+        progression = next(iter(progressions.values()))
+        start = users[0].progress[progression.name]
+
+        raters, rounds, intervals = 3, 20, 40
+        errors = []
+        done = threading.Event()
+
+        def rate(user):
+            try:
+                client = app.test_client()
+                for _ in range(rounds):
+                    point = bot.users[user.id].user.progress[progression.name]
+                    resp = client.post("/interactive", data={"payload": rating_payload(
+                        user, progression.name, point.workout, "1.0", digest=False)})
+                    assert_equal(resp.status_code, 200)
+            except Exception as e:
+                errors.append(e)
+
+        def set_intervals(user):
+            try:
+                client = app.test_client()
+                for interval in range(1, intervals + 1):
+                    resp = client.post("/set-interval", data={
+                        "text": str(interval), "user_id": user.id})
+                    assert_equal(resp.status_code, 200)
+            except Exception as e:
+                errors.append(e)
+
+        def schedule():
+            try:
+                while not done.is_set():
+                    for status in bot.users.snapshot().values():
+                        scheduler.send_challenge_to(bot, status.user)
+            except Exception as e:
+                errors.append(e)
+
+        # Switch threads far more often than usual to expose races
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            bot.refresh_users(bot.db())
+            scheduler_t = threading.Thread(target=schedule)
+            scheduler_t.start()
+            workers = [threading.Thread(target=rate, args=(user,))
+                       for user in users for _ in range(raters)]
+            workers += [threading.Thread(target=set_intervals, args=(user,))
+                        for user in users]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            done.set()
+            scheduler_t.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        assert_equal(errors, [])
+        expected = start
+        for _ in range(raters * rounds):
+            expected = expected.next_point(CompletedDifficulty.EASY)
+        conn = setup_db(os.path.join(d, "workout.db"))
+        for user in users:
+            saved = User.from_db(conn, user.id, progressions)
+            assert_equal(saved.interval, intervals)
+            assert_equal(saved.progress[progression.name], expected)
+        conn.close()
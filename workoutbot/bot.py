@@ -0,0 +1,131 @@
+from .progression import User
+from .roster import RosterSync, record_member_event
+from .status import UserStatus, UserRegistry, RAMP_UP_WINDOW
+from .utils import DBNAME, setup_db, load_exercises
+
+import os
+import sqlite3
+import threading
+
+EXERCISES="exercises.json"
+
+class Bot:
+    """State shared by the web handlers and the scheduler in one process.
+
+    Nothing is created up front: the Slack client, database connections,
+    exercises and users are set up on first use, and the Slack client and
+    connections are recreated if the process has forked since."""
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ["SLACK_TOKEN"],
+                   os.environ["SLACK_SIGNING_SECRET"],
+                   os.environ["SLACK_WORKOUT_CHAN_ID"],
+                   db_name=os.environ.get("WORKOUTBOT_DB", DBNAME),
+                   digest_mode=os.environ.get("WORKOUTBOT_DIGEST", "") not in ("", "0"),
+                   ramp_up_window=float(os.environ.get("WORKOUTBOT_RAMP_UP_WINDOW",
+                                                       RAMP_UP_WINDOW)))
+
+    def __init__(self, token, signing_secret, channel_id, db_name=DBNAME,
+                 exercises=EXERCISES, digest_mode=False,
+                 ramp_up_window=RAMP_UP_WINDOW):
+        self.token = token
+        self.signing_secret = signing_secret
+        self.channel_id = channel_id
+        self.db_name = db_name
+        self.exercises = exercises
+        # Post all challenges due in a tick as a single channel message
+        self.digest_mode = digest_mode
+        self.ramp_up_window = ramp_up_window
+        self.users = UserRegistry()
+        # Set to wake the scheduler early when a user's schedule changes
+        self.schedule_changed = threading.Event()
+        self._sc = None
+        self._sc_pid = None
+        self._roster = None
+        self._progressions = None
+        self._local = threading.local()
+        self._migrate_lock = threading.Lock()
+        self._migrated_pid = None
+        self._refresh_lock = threading.Lock()
+        self._modified = None
+
+    @property
+    def sc(self):
+        if self._sc is None or self._sc_pid != os.getpid():
+            from slackclient import SlackClient
+            self._sc = SlackClient(self.token)
+            self._sc_pid = os.getpid()
+        return self._sc
+
+    @property
+    def roster(self):
+        if self._roster is None:
+            self._roster = RosterSync(lambda: self.sc, self.channel_id, self.db)
+        return self._roster
+
+    def member_joined(self, member):
+        # Events go through the database because the scheduler may run in
+        # another process
+        record_member_event(self.db(), self.channel_id, member, True)
+
+    def member_left(self, member):
+        record_member_event(self.db(), self.channel_id, member, False)
+
+    @property
+    def progressions(self):
+        if self._progressions is None:
+            self._progressions = load_exercises(self.exercises)
+        return self._progressions
+
+    def db(self):
+        """Return this thread's database connection, opening it if needed.
+        The schema is only set up by the first connection in each process."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            with self._migrate_lock:
+                if self._migrated_pid != os.getpid():
+                    setup_db(self.db_name).close()
+                    self._migrated_pid = os.getpid()
+            conn = self._local.conn = sqlite3.connect(self.db_name)
+            self._local.pid = os.getpid()
+        return conn
+
+    def refresh_users(self, conn):
+        """Load users saved since the last refresh by another process. The
+        first call loads every user. When nothing has changed this costs a
+        single indexed query, and no lock is held while users are loaded."""
+        latest, = conn.execute("select max(modified) from user").fetchone()
+        with self._refresh_lock:
+            since = self._modified
+        if since is not None and (latest or 0) <= since:
+            return self.users
+
+        if since is None:
+            res = conn.execute("select id, modified from user")
+        else:
+            res = conn.execute("""
+            select id, modified from user where modified > ?
+            """, (since,))
+        for id, modified in res.fetchall():
+            # Skip users this process saved itself
+            if id in self.users and (self.users[id].user.modified or 0) >= (modified or 0):
+                continue
+            user = User.from_db(conn, id, self.progressions)
+            with self.users.lock(id):
+                if id in self.users:
+                    status = self.users[id]
+                    if (status.user.modified or 0) >= (user.modified or 0):
+                        continue
+                    # Saves from other processes carry a stale value
+                    user.last_progression = status.user.last_progression
+                    status.user = user
+                else:
+                    status = UserStatus(user=user)
+                    # Later roster syncs only report members that change
+                    if self._roster is not None:
+                        status.in_channel = id in self._roster.members
+                    self.users.add(status)
+
+        with self._refresh_lock:
+            self._modified = max(self._modified or 0, latest or 0)
+        return self.users
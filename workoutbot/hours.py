@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Default availability window, used for users who have not configured
+# their own working hours
+DEFAULT_TIMEZONE="America/Chicago"
+DEFAULT_WORK_START=8
+DEFAULT_WORK_END=17
+DEFAULT_WORK_DAYS=frozenset([0, 1, 2, 3, 4])
+
+DAY_NAMES=["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def parse_days(text):
+    """Parse days like 'mon-thu' or 'mon,wed,fri' into a set of weekday
+    numbers (Monday is 0). Ranges may wrap, e.g. 'sat-mon'. Raises
+    ValueError for anything else."""
+    days = set()
+    for part in text.lower().split(","):
+        ends = [DAY_NAMES.index(d.strip()[:3]) for d in part.split("-")]
+        if len(ends) == 1:
+            days.add(ends[0])
+        elif len(ends) == 2:
+            first, last = ends
+            for i in range((last - first) % 7 + 1):
+                days.add((first + i) % 7)
+        else:
+            raise ValueError("Bad day range: {}".format(part))
+    return days
+
+def format_days(days):
+    return ",".join(DAY_NAMES[d] for d in sorted(days))
+
+def local_time(user, now):
+    return datetime.fromtimestamp(now, timezone.utc).astimezone(
+        ZoneInfo(user.timezone))
+
+def is_working_hours(user, now):
+    t = local_time(user, now)
+    return (t.weekday() in user.work_days and
+            user.work_start <= t.hour < user.work_end)
+
+def next_window_open(user, now):
+    """Return the UTC timestamp at which the user's availability window
+    next opens, or 'now' if the user is currently in it. Returns None if
+    the user has no working days at all."""
+    if is_working_hours(user, now):
+        return now
+    t = local_time(user, now)
+    tz = ZoneInfo(user.timezone)
+    for days in range(8):
+        day = t.date() + timedelta(days=days)
+        if day.weekday() not in user.work_days:
+            continue
+        opens = datetime(day.year, day.month, day.day, user.work_start,
+                         tzinfo=tz)
+        if opens > t:
+            return opens.timestamp()
+    return None
+
+def next_wake(users, now, poll_interval):
+    """Return how many seconds the scheduler can sleep before either the
+    next poll is due for an available user or some user's window opens.
+    Returns None if no user is ever available."""
+    sleep = None
+    for user in users:
+        opens = next_window_open(user, now)
+        if opens is None:
+            continue
+        wait = poll_interval if opens <= now else opens - now
+        if sleep is None or wait < sleep:
+            sleep = wait
+    return sleep
@@ -0,0 +1,57 @@
+import json
+
+DIGEST_TEXT="Time to work out!"
+
+# Slack rejects messages with more attachments than this
+MAX_ATTACHMENTS=100
+
+def challenge_attachment(challenge):
+    text = "{} {} {} @{}!".format(challenge.count, challenge.workout.unit,
+                                  challenge.workout.name, challenge.user.name)
+    if challenge.workout.howto:
+        howto = "<{}|HowTo Video>".format(challenge.workout.howto)
+    else:
+        howto = ""
+    return {
+        "text": text,
+        "footer": ": ".join(["Part of the '{}' progression".format(
+                               challenge.progression.name),
+                             howto,
+                             challenge.workout.extra])
+    }
+
+def digest_attachments(challenges):
+    return [challenge_attachment(c) for c in challenges]
+
+def done_prompt_attachments(challenge, ts, digest=False):
+    def value(status):
+        v = {
+            "status": status,
+            "progression": challenge.progression.name,
+            "workout": challenge.workout.name,
+            "ts": ts
+        }
+        if digest:
+            v["digest"] = True
+        return json.dumps(v)
+
+    return [
+        {
+            "text": "Could you do it?",
+            "callback_id": "workout_done",
+            "attachment_type": "default",
+            "actions": [
+                {
+                    "name": "completed",
+                    "text": ":heavy_check_mark:",
+                    "type": "button",
+                    "value": value("completed")
+                },
+                {
+                    "name": "fail",
+                    "text": ":heavy_multiplication_x:",
+                    "type": "button",
+                    "value": value("fail")
+                },
+            ]
+        }]
@@ -5,6 +5,9 @@ import random
 import math
 import pickle
 
+from .hours import (DEFAULT_TIMEZONE, DEFAULT_WORK_START, DEFAULT_WORK_END,
+                    DEFAULT_WORK_DAYS)
+
 # Challenge values are selected at random from the
 # range 'user progress point +/- CHALLENGE_RANDOM_RANGE'
 CHALLENGE_RANDOM_RANGE=0.01
@@ -117,11 +120,24 @@ class User:
     @classmethod
     def from_db(cls, conn, id, progressions):
         c = conn.cursor()
-        name, interval, focus, exclude, last_progression = c.execute("""
-        select name, interval, focus, exclude, last_progression from user where id = ?;
+        (name, interval, focus, exclude, last_progression,
+         timezone, work_start, work_end, work_days, modified) = c.execute("""
+        select name, interval, focus, exclude, last_progression,
+               timezone, work_start, work_end, work_days, modified
+        from user where id = ?;
         """, (id,)).fetchone()
         user = cls(id, name, interval, pickle.loads(focus), pickle.loads(exclude),
                    last_progression)
+        # Users saved before working hours were configurable have NULLs here
+        if timezone is not None:
+            user.timezone = timezone
+        if work_start is not None:
+            user.work_start = work_start
+        if work_end is not None:
+            user.work_end = work_end
+        if work_days is not None:
+            user.work_days = pickle.loads(work_days)
+        user.modified = modified
 
         res = c.execute("""
         select progression, workout, count from user_progress
@@ -131,13 +147,20 @@ class User:
             user.register_point(progressions[progression], workout, count)
         return user
 
-    def __init__(self, id, name, interval, focus=set([]), exclude=set([]), last_progression=None):
+    def __init__(self, id, name, interval, focus=set([]), exclude=set([]), last_progression=None,
+                 timezone=DEFAULT_TIMEZONE, work_start=DEFAULT_WORK_START,
+                 work_end=DEFAULT_WORK_END, work_days=DEFAULT_WORK_DAYS):
         self.id = id
         self.name = name
         self.focus = focus
         self.exclude = exclude
         self.interval = interval
         self.last_progression = last_progression
+        self.timezone = timezone
+        self.work_start = work_start
+        self.work_end = work_end
+        self.work_days = work_days
+        self.modified = None
         self.progress = {}
 
     def __eq__(self, other):
@@ -145,16 +168,27 @@ class User:
 
     def save(self, conn):
         c = conn.cursor()
-        c.execute("delete from user where id = ?", (self.id,))
         c.execute("delete from user_progress where user_id = ?", (self.id,))
+        # 'modified' increases with every save so that other processes can
+        # pick up changed users with a single query. It is read after the
+        # first write so the database is already locked against other savers.
+        modified, = c.execute(
+            "select coalesce(max(modified), 0) + 1 from user").fetchone()
+        c.execute("delete from user where id = ?", (self.id,))
 
-        c.execute("insert into user values(?, ?, ?, ?, ?, ?)",
-                  (self.id, self.name, self.interval, pickle.dumps(self.focus),
-                   pickle.dumps(self.exclude), self.last_progression))
+        c.execute("""
+        insert into user(id, name, interval, focus, exclude, last_progression,
+                         timezone, work_start, work_end, work_days, modified)
+        values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.id, self.name, self.interval, pickle.dumps(self.focus),
+              pickle.dumps(self.exclude), self.last_progression,
+              self.timezone, self.work_start, self.work_end,
+              pickle.dumps(self.work_days), modified))
         for p in self.progress.values():
             c.execute("insert into user_progress values(?, ?, ?, ?)",
                       (self.id, p.progression.name, p.workout, p.count))
         conn.commit()
+        self.modified = modified
 
     def register_point(self, progression, workout, count):
         self.progress[progression.name] = ProgressPoint(
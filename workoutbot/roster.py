@@ -0,0 +1,84 @@
+# How often the full channel member list is paged through. Between full
+# syncs the roster is kept current from join/leave events.
+FULL_SYNC_INTERVAL=60*60
+
+# Number of members requested per conversations.members page
+PAGE_SIZE=200
+
+def record_member_event(conn, channel_id, member, joined):
+    """Queue a join/leave event for the RosterSync of whichever process runs
+    the scheduler."""
+    conn.execute("""
+    insert into roster_event(channel, user_id, joined) values(?, ?, ?)
+    """, (channel_id, member, joined))
+    conn.commit()
+
+class RosterSync:
+    def __init__(self, sc, channel_id, db, full_sync_interval=FULL_SYNC_INTERVAL,
+                 page_size=PAGE_SIZE):
+        # Both return this process's current Slack client and this thread's
+        # database connection, so nothing is held across a fork
+        self.sc = sc
+        self.channel_id = channel_id
+        self.db = db
+        self.full_sync_interval = full_sync_interval
+        self.page_size = page_size
+        self.members = set()
+        self.last_full_sync = None
+
+    def take_events(self):
+        conn = self.db()
+        rows = conn.execute("""
+        select id, user_id, joined from roster_event where channel = ? order by id
+        """, (self.channel_id,)).fetchall()
+        if rows:
+            conn.execute("delete from roster_event where channel = ? and id <= ?",
+                         (self.channel_id, rows[-1][0]))
+            conn.commit()
+        return [(member, bool(joined)) for _, member, joined in rows]
+
+    def fetch_members(self):
+        members = set()
+        cursor = None
+        while True:
+            kwargs = {"channel": self.channel_id, "limit": self.page_size}
+            if cursor:
+                kwargs["cursor"] = cursor
+            resp = self.sc().api_call("conversations.members", **kwargs)
+            if not resp.get("ok"):
+                raise RuntimeError("conversations.members failed: {}".format(
+                    resp.get("error")))
+            members.update(resp["members"])
+            cursor = resp.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return members
+
+    def sync(self, now):
+        """Bring the roster up to date and return the (joined, left) sets of
+        members that changed since the last call."""
+        events = self.take_events()
+
+        if (self.last_full_sync is None or
+                now - self.last_full_sync >= self.full_sync_interval):
+            # Events drained above are already reflected in the full list
+            try:
+                members = self.fetch_members()
+            except Exception as e:
+                print("Full roster sync failed, applying events only: ", e)
+            else:
+                self.last_full_sync = now
+                return self._replace(members)
+
+        members = set(self.members)
+        for member, joined in events:
+            if joined:
+                members.add(member)
+            else:
+                members.discard(member)
+        return self._replace(members)
+
+    def _replace(self, members):
+        joined = members - self.members
+        left = self.members - members
+        self.members = members
+        return joined, left
@@ -0,0 +1,173 @@
+from .progression import generate_challenge
+from .hours import is_working_hours, next_wake
+from .status import *
+from .messages import *
+from .bot import Bot
+
+import time
+
+TIME_BEFORE_CHALLENGE=15*60
+
+# How often the challenge thread polls while someone is in working hours
+POLL_INTERVAL=120
+
+# When the scheduler runs in its own process it can't be woken by the web
+# handlers, so it looks for new or changed users at least this often
+REFRESH_INTERVAL=5*60
+
+def update_roster(bot):
+    users = bot.users
+    joined, left = bot.roster.sync(time.time())
+    for member in left:
+        if member in users:
+            print("User {} left the channel".format(users[member].user.name))
+            users[member].in_channel = False
+            users[member].active = False
+    for member in joined:
+        if member not in users:
+            print("Got unregistered user: {}".format(member))
+            continue
+        users[member].in_channel = True
+
+def needs_presence(status, now):
+    """Presence is only polled for users who could be challenged soon:
+    those not yet active, so their settle-in time can start, and active
+    users whose next challenge is close enough to need confirming."""
+    if not status.in_channel:
+        return False
+    if not status.active:
+        return True
+    return status.challenge_due(now + TIME_BEFORE_CHALLENGE + POLL_INTERVAL)
+
+def update_active_users(bot, statuses):
+    now = time.time()
+    for status in statuses:
+        if not needs_presence(status, now):
+            continue
+        # For some reason this api endpoint sometimes returns invalid JSON, so catch
+        # the exception here
+        try:
+            info = bot.sc.api_call("users.getPresence", user=status.user.id)
+        except Exception as e:
+            print("users.getPresence api call failed (user={}): ".format(
+                status.user.id), e)
+            return
+        if "presence" not in info or info["presence"] != "active":
+            print("User {} is not active (presence={})".format(
+                 status.user.name, info.get("presence")))
+            status.active = False
+        elif info["presence"] == "active" and not status.active:
+            print("User {} becomes active".format(status.user.name))
+            status.active = True
+            status.last_became_active = time.time()
+
+def send_challenge_to(bot, user):
+    with bot.users.lock(user.id):
+        challenge = generate_challenge(user)
+        user.challenged_with(challenge)
+    print("Challenge for {}: {}".format(user.name, challenge))
+    msg_res = bot.sc.api_call("chat.postMessage", channel=bot.channel_id,
+                              attachments=[challenge_attachment(challenge)],
+                              link_names=True)
+
+    bot.sc.api_call("chat.postEphemeral", channel=bot.channel_id, user=user.id,
+                    attachments=done_prompt_attachments(challenge, msg_res["ts"]))
+
+def send_digest_to(bot, due):
+    challenges = []
+    for user in due:
+        with bot.users.lock(user.id):
+            challenge = generate_challenge(user)
+            user.challenged_with(challenge)
+        print("Challenge for {}: {}".format(user.name, challenge))
+        challenges.append(challenge)
+    for i in range(0, len(challenges), MAX_ATTACHMENTS):
+        batch = challenges[i:i+MAX_ATTACHMENTS]
+        msg_res = bot.sc.api_call("chat.postMessage", channel=bot.channel_id,
+                                  text=DIGEST_TEXT,
+                                  attachments=digest_attachments(batch),
+                                  link_names=True)
+        for challenge in batch:
+            bot.sc.api_call("chat.postEphemeral", channel=bot.channel_id,
+                            user=challenge.user.id,
+                            attachments=done_prompt_attachments(challenge, msg_res["ts"],
+                                                                digest=True))
+
+def prepare(bot):
+    """Load users and their saved scheduler state, and spread out the
+    challenges that are already due."""
+    conn = bot.db()
+    users = bot.refresh_users(conn)
+    restore_statuses(conn, users)
+    spread_due_challenges(users.values(), time.time(), bot.ramp_up_window)
+    print("Loaded {} users".format(len(users)))
+
+def challenge_thread(bot, max_sleep=None):
+    conn = bot.db()
+    while True:
+        bot.schedule_changed.clear()
+        statuses = bot.refresh_users(conn).snapshot()
+        now = time.time()
+        working = [u for u in statuses.values() if is_working_hours(u.user, now)]
+        update_roster(bot)
+        if working:
+            update_active_users(bot, working)
+        due = []
+        for user in working:
+            if not user.active:
+                print("Skipping {}: not active".format(user.user.name))
+                continue
+            now = time.time()
+            time_from_active = now - user.last_became_active
+            if time_from_active < TIME_BEFORE_CHALLENGE:
+                print("Skipping {}: not long enough time from active ({})".format(
+                    user.user.name,
+                    time_from_active))
+                continue
+
+            if user.not_before is not None and now < user.not_before:
+                print("Skipping {}: ramping up after restart ({:.0f}s left)".format(
+                    user.user.name, user.not_before - now))
+                continue
+
+            if user.challenge_due(now):
+                print("Sending challenge to {} (last challenged {})".format(
+                    user.user.name, user.last_challenged))
+                due.append(user)
+            else:
+                print("Not sending challenge to {}, not long enough from last challenge ({})".format(
+                    user.user.name, now - user.last_challenged))
+
+        if due and bot.digest_mode:
+            send_digest_to(bot, [u.user for u in due])
+        else:
+            for user in due:
+                send_challenge_to(bot, user.user)
+        now = time.time()
+        for user in due:
+            user.last_challenged = now
+            user.not_before = None
+        checkpoint_statuses(conn, statuses.values())
+
+        now = time.time()
+        sleep = next_wake([u.user for u in statuses.values()], now, POLL_INTERVAL)
+        ramping = [u.not_before - now for u in statuses.values()
+                   if u.not_before is not None and u.not_before > now]
+        if ramping and sleep is not None:
+            sleep = min(sleep, min(ramping))
+        if max_sleep is not None and (sleep is None or sleep > max_sleep):
+            sleep = max_sleep
+        if sleep is None:
+            print("No users have working hours, sleeping until schedules change")
+        else:
+            print("Sleeping for {:.0f} seconds".format(sleep))
+        bot.schedule_changed.wait(sleep)
+
+def run_scheduler():
+    """Run the scheduler in its own process, separately from the web app."""
+    bot = Bot.from_env()
+    prepare(bot)
+    challenge_thread(bot, max_sleep=REFRESH_INTERVAL)
+
+if __name__ == "__main__":
+    run_scheduler()
@@ -1,36 +1,17 @@
-from flask import Flask, request, jsonify, g
-from slackclient import SlackClient
+from flask import Flask, Blueprint, current_app, request, jsonify
 from slackeventsapi import SlackEventAdapter
-from collections import defaultdict
 
 from .progression import *
 from .utils import *
+from .bot import Bot
+from .hours import parse_days, format_days
+from . import scheduler
 
-import sqlite3
 import json
-import os
-import time
 import threading
+from zoneinfo import ZoneInfo
 
-TIME_BEFORE_CHALLENGE=15*60
-
-sc = SlackClient(os.environ["SLACK_TOKEN"])
-slash_app = Flask(__name__)
-slack_signing_secret = os.environ["SLACK_SIGNING_SECRET"]
-slack_events_adapter = SlackEventAdapter(slack_signing_secret, "/slack/events")
-channel_id = os.environ["SLACK_WORKOUT_CHAN_ID"]
-users = None
-
-# Fixup the timezone
-os.environ["TZ"]="US/Central"
-time.tzset()
-
-class UserStatus:
-    def __init__(self, user):
-        self.user = user
-        self.active = False
-        self.last_challenged = None
-        self.last_became_active = None
+slash = Blueprint("workoutbot", __name__)
 
 def generate_register_attachments(progressions):
     attachments = []
@@ -58,16 +39,9 @@ def generate_register_attachments(progressions):
             })
     return attachments
 
-def is_working_hours():
-    t = time.localtime()
-    if t.tm_wday not in [5, 6] and (
-         t.tm_hour >= 8 and t.tm_hour < 17):
-        return True
-    return False
-
-@slash_app.route("/set-interval", methods=["POST"])
+@slash.route("/set-interval", methods=["POST"])
 def set_interval():
-    global users
+    users = get_users()
     interval = request.form["text"]
     if len(interval) == 0:
         return jsonify({
@@ -80,14 +54,79 @@ def set_interval():
             "text": "Error: Please register first with `/workoutbot-register`"
         })
     user = users[request.form["user_id"]]
-    user.user.interval = int(interval)
-    user.user.save(get_db())
+    with users.lock(user.user.id):
+        user.user.interval = int(interval)
+        user.user.save(get_db())
     return jsonify({
         "response_type": "ephemeral",
         "text": "Interval set to every {} minutes".format(interval)
     })
 
-@slash_app.route("/register", methods=["POST"])
+@slash.route("/set-hours", methods=["POST"])
+def set_hours():
+    users = get_users()
+    args = request.form["text"].split()
+    try:
+        start, end = [int(h) for h in args[0].split("-")]
+        days = parse_days(args[1]) if len(args) > 1 else None
+        if len(args) > 2:
+            raise ValueError("Too many arguments")
+    except (ValueError, IndexError):
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Error: Expected working hours like `8-17` or `8-17 mon-thu`"
+        })
+    if not (0 <= start < end <= 24):
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Error: Working hours must be within 0-24 and start before they end"
+        })
+    elif request.form["user_id"] not in users:
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Error: Please register first with `/workoutbot-register`"
+        })
+    user = users[request.form["user_id"]]
+    with users.lock(user.user.id):
+        user.user.work_start = start
+        user.user.work_end = end
+        if days is not None:
+            user.user.work_days = days
+        user.user.save(get_db())
+    get_bot().schedule_changed.set()
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": "Working hours set to {}:00-{}:00 on {} ({})".format(
+            start, end, format_days(user.user.work_days), user.user.timezone)
+    })
+
+@slash.route("/set-timezone", methods=["POST"])
+def set_timezone():
+    users = get_users()
+    timezone = request.form["text"].strip()
+    try:
+        ZoneInfo(timezone)
+    except (ValueError, KeyError):
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Error: Unknown timezone '{}'".format(timezone)
+        })
+    if request.form["user_id"] not in users:
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Error: Please register first with `/workoutbot-register`"
+        })
+    user = users[request.form["user_id"]]
+    with users.lock(user.user.id):
+        user.user.timezone = timezone
+        user.user.save(get_db())
+    get_bot().schedule_changed.set()
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": "Timezone set to {}".format(timezone)
+    })
+
+@slash.route("/register", methods=["POST"])
 def register():
     progressions = get_progressions()
     return jsonify({
@@ -138,14 +177,25 @@ def register():
         ]
     })
 
-def finish_registration(payload):
-    global in_progress_registrations
-    global users
+def save_selection(conn, user_id, key, value):
+    # Selections are kept in the database because the callbacks for one
+    # registration may be handled by different worker processes
+    conn.execute("""
+    insert or replace into registration(user_id, key, value) values(?, ?, ?)
+    """, (user_id, key, value))
+    conn.commit()
+
+def load_selections(conn, user_id):
+    res = conn.execute("select key, value from registration where user_id = ?",
+                       (user_id,))
+    return dict(res.fetchall())
 
-    selections = in_progress_registrations[payload["user"]["name"]]
+def finish_registration(payload):
+    conn = get_db()
+    selections = load_selections(conn, payload["user"]["id"])
     progs = get_progressions()
     user = User(payload["user"]["id"], payload["user"]["name"],
-                selections["interval"])
+                int(selections["interval"]))
     for p in progs.values():
         if p.name in selections:
             stage = p.stage(selections[p.name])
@@ -155,9 +205,11 @@ def finish_registration(payload):
             stage = p.stages[0]
             avg = (stage.min + stage.max) / 2
             user.register_point(p, stage.workout.name, avg)
-    user.save(get_db())
-    del in_progress_registrations[payload["user"]["name"]]
-    users[user.id] = UserStatus(user=user)
+    user.save(conn)
+    conn.execute("delete from registration where user_id = ?", (user.id,))
+    conn.commit()
+    get_users()
+    get_bot().schedule_changed.set()
 
     return jsonify({"text": "Registration complete!"})
 
@@ -188,14 +240,14 @@ def workout_done(payload):
         })
 
 def workout_rating(payload):
-    global users
+    bot = get_bot()
+    users = get_users()
 
     value = json.loads(payload["actions"][0]["value"])
     progression = value["progression"]
     workout = value["workout"]
     difficulty = payload["actions"][0]["name"]
     user = users[payload["user"]["id"]]
-    point = user.user.progress[progression]
     if value["status"] == "completed":
         if difficulty == "Very easy":
             difficulty = CompletedDifficulty.VERY_EASY
@@ -209,7 +261,6 @@ def workout_rating(payload):
             difficulty = CompletedDifficulty.VERY_HARD
         else:
             raise RuntimeError("Unknown difficulty: {}".format(difficulty))
-        point = point.next_point(difficulty)
         mark = "heavy_check_mark"
     else:
         if difficulty == "Very far":
@@ -224,13 +275,25 @@ def workout_rating(payload):
             difficulty = FailureDifficulty.VERY_CLOSE
         else:
             raise RuntimeError("Unknown difficulty: {}".format(difficulty))
-        point = point.prev_point(difficulty)
         mark = "heavy_multiplication_x"
-    user.user.update_progress(point)
-    user.user.save(get_db())
 
-    res = sc.api_call("reactions.add", name=mark,
-                      timestamp=value["ts"], channel=channel_id)
+    with users.lock(user.user.id):
+        point = user.user.progress[progression]
+        if value["status"] == "completed":
+            point = point.next_point(difficulty)
+        else:
+            point = point.prev_point(difficulty)
+        user.user.update_progress(point)
+        user.user.save(get_db())
+
+    if value.get("digest"):
+        # The digest is shared, so a reaction wouldn't say whose result it is
+        res = bot.sc.api_call("chat.postMessage", channel=bot.channel_id,
+                              thread_ts=value["ts"], link_names=True,
+                              text=":{}: @{}".format(mark, user.user.name))
+    else:
+        res = bot.sc.api_call("reactions.add", name=mark,
+                              timestamp=value["ts"], channel=bot.channel_id)
     print(res)
 
     return jsonify({
@@ -240,12 +303,8 @@ def workout_rating(payload):
         'delete_original': True
     })
 
-in_progress_registrations = defaultdict(dict)
-@slash_app.route("/interactive", methods=["POST"])
+@slash.route("/interactive", methods=["POST"])
 def interactive():
-    global in_progress_registrations
-    global users
-
     payload = json.loads(request.form["payload"])
     print(payload)
 
@@ -255,156 +314,63 @@ def interactive():
     elif callback == "user_register_setup":
         progression = payload["actions"][0]["name"]
         workout = payload["actions"][0]["selected_options"][0]["value"]
-        in_progress_registrations[payload["user"]["name"]][progression] = workout
+        save_selection(get_db(), payload["user"]["id"], progression, workout)
         return ""
     elif callback == "user_register_interval":
         interval = int(payload["actions"][0]["selected_options"][0]["value"])
-        in_progress_registrations[payload["user"]["name"]]["interval"] = interval
+        save_selection(get_db(), payload["user"]["id"], "interval", interval)
         return ""
     elif callback == "workout_done":
         return workout_done(payload)
     elif callback == "workout_rating":
         return workout_rating(payload)
 
+def get_bot():
+    return current_app.extensions["workoutbot"]
+
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = setup_db(DBNAME)
-    return db
+    return get_bot().db()
 
 def get_progressions():
-    prog = getattr(g, '_progressions', None)
-    if prog is None:
-        prog = g._progressions = load_exercises("exercises.json")
-    return prog
-
-def update_active_users():
-    global users
-    resp = sc.api_call("conversations.members", channel=channel_id)
-    for member in resp["members"]:
-        if member not in users:
-            print("Got unregistered user: {}".format(member))
-            continue
-        # For some reason this api endpoint sometimes returns invalid JSON, so catch
-        # the exception here
-        try:
-            info = sc.api_call("users.getPresence", user=member)
-        except Exception as e:
-            print("users.getPresence api call failed (user={}): ".format(member), e)
-            return
-        if "presence" not in info or info["presence"] != "active":
-            print("User {} is not active (presence={})".format(
-                 users[member].user.name, info["presence"]))
-            users[member].active = False
-        elif info["presence"] == "active" and not users[member].active:
-            print("User {} becomes active".format(users[member].user.name))
-            users[member].active = True
-            users[member].last_became_active = time.time()
-
-
-def send_challenge_to(user):
-    challenge = generate_challenge(user)
-    print("Challenge for {}: {}".format(user.name, challenge))
-    text = "{} {} {} @{}!".format(challenge.count, challenge.workout.unit,
-                                  challenge.workout.name, challenge.user.name)
-    if challenge.workout.howto:
-        howto = "<{}|HowTo Video>".format(challenge.workout.howto)
-    else:
-        howto = ""
-    attachments = [
-        {
-            "text": text,
-            "footer": ": ".join(["Part of the '{}' progression".format(
-                                   challenge.progression.name),
-                                 howto,
-                                 challenge.workout.extra])
-        }
-    ]
-    msg_res =sc.api_call("chat.postMessage", channel=channel_id,
-                attachments=attachments, link_names=True)
-    user.challenged_with(challenge)
-
-    sc.api_call("chat.postEphemeral", channel=channel_id, user=user.id,
-                attachments=[
-                    {
-                        "text": "Could you do it?",
-                        "callback_id": "workout_done",
-                        "attachment_type": "default",
-                        "actions": [
-                            {
-                                "name": "completed",
-                                "text": ":heavy_check_mark:",
-                                "type": "button",
-                                "value": json.dumps({
-                                    "status": "completed",
-                                    "progression": challenge.progression.name,
-                                    "workout": challenge.workout.name,
-                                    "ts": msg_res["ts"]
-                                })
-                            },
-                            {
-                                "name": "fail",
-                                "text": ":heavy_multiplication_x:",
-                                "type": "button",
-                                "value": json.dumps({
-                                    "status": "fail",
-                                    "progression": challenge.progression.name,
-                                    "workout": challenge.workout.name,
-                                    "ts": msg_res["ts"]
-                                })
-                            },
-                        ]
-                    }])
-
-def challenge_thread():
-    global users
-    while True:
-        if not is_working_hours():
-            # Sleep for half an hour
-            print("Not work hours, sleeping for 1800 seconds")
-            time.sleep(1800)
-            continue
-
-        update_active_users()
-        for user in users.values():
-            if not user.active:
-                print("Skipping {}: not active".format(user.user.name))
-                continue
-            now = time.time()
-            time_from_active = now - user.last_became_active
-            if time_from_active < TIME_BEFORE_CHALLENGE:
-                print("Skipping {}: not long enough time from active ({})".format(
-                    user.user.name,
-                    time_from_active))
-                continue
-
-            if user.last_challenged is not None:
-                time_from_challenge = now - user.last_challenged
-
-                if time_from_challenge/60 > user.user.interval:
-                    send_challenge_to(user.user)
-                    user.last_challenged = now
-                else:
-                    print("Not sending challenge to {}, not long enough from last challenge ({})".format(
-                        user.user.name, time_from_challenge))
-            else:
-                print("User {} not previously challenged, sending".format(user.user.name))
-                send_challenge_to(user.user)
-                user.last_challenged = now
-        print("Sleeping for 120 seconds")
-        time.sleep(120)
+    return get_bot().progressions
+
+def get_users():
+    bot = get_bot()
+    return bot.refresh_users(bot.db())
+
+def create_app(bot=None):
+    """Build the web app. Slack clients and database connections are only
+    created once a request needs them, so this is cheap to call and safe
+    to call before a WSGI server forks its workers."""
+    if bot is None:
+        bot = Bot.from_env()
+    app = Flask(__name__)
+    app.extensions["workoutbot"] = bot
+    app.register_blueprint(slash)
+    events = SlackEventAdapter(bot.signing_secret, "/slack/events", server=app)
+
+    @events.on("member_joined_channel")
+    def member_joined_channel(event_data):
+        event = event_data["event"]
+        if event["channel"] == bot.channel_id:
+            bot.member_joined(event["user"])
+
+    @events.on("member_left_channel")
+    def member_left_channel(event_data):
+        event = event_data["event"]
+        if event["channel"] == bot.channel_id:
+            bot.member_left(event["user"])
+
+    return app
 
 def run():
-    global users
-    conn = setup_db(DBNAME)
-    progressions = load_exercises("exercises.json")
-    users = {}
-    for (id,) in conn.execute("select id from user").fetchall():
-        users[id] = UserStatus(user=User.from_db(conn, id, progressions))
-    print("Loaded {} users".format(len(users)))
-    challenge_t = threading.Thread(target=challenge_thread)
+    """Serve the web app and run the scheduler in the same process."""
+    app = create_app()
+    bot = app.extensions["workoutbot"]
+    scheduler.prepare(bot)
+    challenge_t = threading.Thread(target=scheduler.challenge_thread, args=(bot,))
     challenge_t.start()
-    slash_app.run(host="0.0.0.0", port=54325)
+    app.run(host="0.0.0.0", port=54325)
 
 if __name__ == "__main__":
     run()
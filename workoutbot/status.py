@@ -0,0 +1,118 @@
+from .hours import next_window_open
+
+import random
+import threading
+
+# Users who are due for a challenge when the bot starts are spread
+# randomly over this many seconds instead of all being challenged at once
+RAMP_UP_WINDOW=10*60
+
+class UserStatus:
+    def __init__(self, user):
+        self.user = user
+        self.active = False
+        self.in_channel = False
+        self.last_challenged = None
+        self.last_became_active = None
+        self.not_before = None
+        self._saved = None
+
+    def challenge_due(self, now):
+        if self.last_challenged is None:
+            return True
+        return (now - self.last_challenged)/60 > self.user.interval
+
+    def state(self):
+        # The last progression is chosen by the scheduler, so it is saved
+        # here rather than with the rest of the user
+        return (self.active, self.last_challenged, self.last_became_active,
+                self.user.last_progression)
+
+    def restore(self, active, last_challenged, last_became_active,
+                last_progression):
+        self.active = bool(active)
+        self.last_challenged = last_challenged
+        self.last_became_active = last_became_active
+        if last_progression is not None:
+            self.user.last_progression = last_progression
+        self._saved = self.state()
+
+    def __repr__(self):
+        return "UserStatus(user='{}', active={}, last_challenged={}, last_became_active={})".format(
+            self.user.id, self.active, self.last_challenged, self.last_became_active)
+
+def restore_statuses(conn, statuses):
+    res = conn.execute("""
+    select user_id, active, last_challenged, last_became_active, last_progression
+    from user_status
+    """)
+    for user_id, *state in res.fetchall():
+        if user_id in statuses:
+            statuses[user_id].restore(*state)
+
+def checkpoint_statuses(conn, statuses):
+    """Write the statuses that changed since they were last saved. Returns
+    the number of rows written."""
+    changed = [s for s in statuses if s.state() != s._saved]
+    if not changed:
+        return 0
+    conn.executemany("""
+    insert or replace into user_status(user_id, active, last_challenged,
+                                       last_became_active, last_progression)
+    values(?, ?, ?, ?, ?)
+    """, [(s.user.id,) + s.state() for s in changed])
+    conn.commit()
+    for s in changed:
+        s._saved = s.state()
+    return len(changed)
+
+def spread_due_challenges(statuses, now, window):
+    for status in statuses:
+        if status.challenge_due(now):
+            # Spread from when the user becomes available, otherwise an
+            # off-hours start leaves everyone due at the same window opening
+            opens = next_window_open(status.user, now)
+            start = now if opens is None else max(now, opens)
+            status.not_before = start + random.uniform(0, window)
+
+# Number of locks shared between users in a UserRegistry
+LOCK_STRIPES=16
+
+class UserRegistry:
+    """Maps user ids to UserStatus objects.
+
+    Changes to a user are made while holding that user's lock, which is one
+    of a fixed set of locks striped by user id, so handlers for different
+    users never wait on each other. The id -> status mapping itself is
+    copy-on-write: adding a user replaces the dict, so the scheduler can
+    iterate over a snapshot without holding any lock."""
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._write_lock = threading.Lock()
+        self._statuses = {}
+
+    def lock(self, user_id):
+        return self._locks[hash(user_id) % len(self._locks)]
+
+    def add(self, status):
+        with self._write_lock:
+            statuses = dict(self._statuses)
+            statuses[status.user.id] = status
+            self._statuses = statuses
+
+    def snapshot(self):
+        """Return the current id -> status mapping. It is never modified
+        after being returned, but must not be modified by the caller."""
+        return self._statuses
+
+    def values(self):
+        return self._statuses.values()
+
+    def __getitem__(self, user_id):
+        return self._statuses[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._statuses
+
+    def __len__(self):
+        return len(self._statuses)
@@ -14,7 +14,12 @@ def setup_db(name):
        interval INTEGER NOT NULL,
        focus TEXT,
        exclude TEXT,
-       last_progression TEXT
+       last_progression TEXT,
+       timezone TEXT,
+       work_start INTEGER,
+       work_end INTEGER,
+       work_days TEXT,
+       modified INTEGER
     );
 
     CREATE TABLE IF NOT EXISTS user_progress(
@@ -24,10 +29,55 @@ def setup_db(name):
        count REAL,
        FOREIGN KEY (user_id) REFERENCES user(id)
     );
+
+    CREATE TABLE IF NOT EXISTS user_status(
+       user_id TEXT NOT NULL PRIMARY KEY,
+       active INTEGER NOT NULL,
+       last_challenged REAL,
+       last_became_active REAL,
+       last_progression TEXT,
+       FOREIGN KEY (user_id) REFERENCES user(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS roster_event(
+       id INTEGER PRIMARY KEY AUTOINCREMENT,
+       channel TEXT NOT NULL,
+       user_id TEXT NOT NULL,
+       joined INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS registration(
+       user_id TEXT NOT NULL,
+       key TEXT NOT NULL,
+       value TEXT NOT NULL,
+       PRIMARY KEY (user_id, key)
+    );
     """)
+    # Databases created before these columns existed need them added. The
+    # write lock is taken first so processes starting together don't both
+    # try to add the same column.
+    c.execute("BEGIN IMMEDIATE")
+    add_missing_columns(conn, "user", [
+        ("timezone", "TEXT"),
+        ("work_start", "INTEGER"),
+        ("work_end", "INTEGER"),
+        ("work_days", "TEXT"),
+        ("modified", "INTEGER"),
+    ])
+    add_missing_columns(conn, "user_status", [
+        ("last_progression", "TEXT"),
+    ])
+    c.execute("CREATE INDEX IF NOT EXISTS user_modified ON user(modified)")
     conn.commit()
     return conn
 
+def add_missing_columns(conn, table, columns):
+    c = conn.cursor()
+    existing = [row[1] for row in c.execute("pragma table_info({})".format(table))]
+    for name, type in columns:
+        if name not in existing:
+            c.execute("alter table {} add column {} {}".format(table, name, type))
+
 def load_exercises(path):
     with open(path, "r") as f:
         js = json.load(f)